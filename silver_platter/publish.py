@@ -21,7 +21,6 @@ from typing import List, Union, Dict, Optional, Tuple, Any, Callable
 from breezy.branch import Branch
 from breezy import (
     errors,
-    merge as _mod_merge,
     revision as _mod_revision,
 )
 from breezy.errors import PermissionDenied
@@ -317,6 +316,10 @@ class EmptyMergeProposal(Exception):
 def check_proposal_diff(
     other_branch: Branch, main_branch: Branch, stop_revision: Optional[bytes] = None
 ) -> None:
+    # breezy.merge is only needed here and in merge_conflicts, so
+    # don't load it for every importer of this module (e.g. 'svp run --help').
+    from breezy import merge as _mod_merge
+
     if stop_revision is None:
         stop_revision = other_branch.last_revision()
     main_revid = main_branch.last_revision()
@@ -336,8 +339,8 @@ def check_proposal_diff(
         merger.merge_type = _mod_merge.Merge3Merger
         tree_merger = merger.make_merger()
         with tree_merger.make_preview_transform() as tt:
-            changes = tt.iter_changes()
-            if not any(changes):
+            changes = iter(tt.iter_changes())
+            if next(changes, None) is None:
                 raise EmptyMergeProposal(other_branch, main_branch)
 
 
@@ -503,6 +506,8 @@ def merge_conflicts(
     Returns:
       boolean indicating whether the merge would result in conflicts
     """
+    from breezy import merge as _mod_merge
+
     if other_revision is None:
         other_revision = other_branch.last_revision()
     if other_branch.repository.get_graph().is_ancestor(
@@ -604,10 +609,12 @@ def publish_changes(
     if mode not in SUPPORTED_MODES:
         raise ValueError("invalid mode %r" % mode)
 
+    main_revid = main_branch.last_revision()
+
     if stop_revision is None:
         stop_revision = local_branch.last_revision()
 
-    if stop_revision == main_branch.last_revision():
+    if stop_revision == main_revid:
         if existing_proposal is not None:
             logging.info("closing existing merge proposal - no new revisions")
             existing_proposal.close()
@@ -620,7 +627,12 @@ def publish_changes(
         logging.info("No changes added; making sure merge proposal is up to date.")
 
     if hoster is None:
-        hoster = get_hoster(main_branch)
+        try:
+            hoster = get_hoster(main_branch)
+        except UnsupportedHoster:
+            # Plain pushes don't need a hoster; push straight to the branch.
+            if mode != MODE_PUSH:
+                raise
 
     if mode == MODE_PUSH_DERIVED:
         (remote_branch, public_url) = push_derived_changes(
@@ -640,7 +652,7 @@ def publish_changes(
             # breezy would do this check too, but we want to be *really* sure.
             with local_branch.lock_read():
                 graph = local_branch.repository.get_graph()
-                if not graph.is_ancestor(main_branch.last_revision(), stop_revision):
+                if not graph.is_ancestor(main_revid, stop_revision):
                     raise errors.DivergedBranches(main_branch, local_branch)
             push_changes(
                 local_branch,
@@ -18,28 +18,26 @@
 """Automatic proposal/push creation."""
 
 import argparse
+from concurrent.futures import Future, ProcessPoolExecutor
+import functools
 import logging
 import os
 import subprocess
 import sys
-from typing import Optional, List
+import tempfile
+from typing import Optional, List, Union
 
 import silver_platter  # noqa: F401
 
-from breezy import osutils
 from breezy import errors
-from breezy.commit import PointlessCommit
-from breezy.workingtree import WorkingTree
-from breezy import propose as _mod_propose
-from .proposal import (
+from breezy.propose import (
+    Hoster,
+    HosterLoginRequired,
+    MergeProposal,
     UnsupportedHoster,
-    enable_tag_pushing,
-    find_existing_proposed,
     get_hoster,
 )
-from .workspace import (
-    Workspace,
-)
+from breezy.workingtree import WorkingTree
 from .publish import (
     SUPPORTED_MODES,
     InsufficientChangesForNewProposal,
@@ -49,186 +47,230 @@ from .utils import (
     BranchMissing,
     BranchUnsupported,
     BranchUnavailable,
+    check_call_script,
     full_branch_url,
+    popen_script,
 )
 
 
+logger = logging.getLogger(__name__)
+
+
+# Size of the reads used to collect script output.
+_SCRIPT_OUTPUT_CHUNK_SIZE = 65536
+
+
 class ScriptMadeNoChanges(errors.BzrError):
 
     _fmt = "Script made no changes."
 
 
 def script_runner(
-    local_tree: WorkingTree, script: str, commit_pending: Optional[bool] = None
+    local_tree: WorkingTree,
+    script: Union[str, List[str]],
+    commit_pending: Optional[bool] = None,
 ) -> str:
     """Run a script in a tree and commit the result.
 
     This ignores newly added files.
 
     :param local_tree: Local tree to run script in
-    :param script: Script to run
+    :param script: Script to run, either as a shell command or as a list of
+        arguments
     :param commit_pending: Whether to commit pending changes
         (True, False or None: only commit if there were no commits by the
          script)
     :return: Description as reported by script
     """
+    from breezy.commit import PointlessCommit
+
     last_revision = local_tree.last_revision()
-    p = subprocess.Popen(
-        script, cwd=local_tree.basedir, stdout=subprocess.PIPE, shell=True
-    )
-    (description_encoded, err) = p.communicate(b"")
+    try:
+        p = popen_script(script, cwd=local_tree.basedir, stdout=subprocess.PIPE)
+    except OSError as e:
+        raise errors.BzrCommandError("Unable to run script %s: %s" % (script, e))
+    description_encoded = bytearray()
+    # Leaving the context closes the pipe and waits for the script to exit,
+    # also if reading is interrupted.
+    with p:
+        assert p.stdout is not None
+        stdout_fd = p.stdout.fileno()
+        while True:
+            chunk = os.read(stdout_fd, _SCRIPT_OUTPUT_CHUNK_SIZE)
+            if not chunk:
+                break
+            description_encoded.extend(chunk)
     if p.returncode != 0:
         raise errors.BzrCommandError(
             "Script %s failed with error code %d" % (script, p.returncode)
         )
-    new_revision = local_tree.last_revision()
     description = description_encoded.decode()
-    if last_revision == new_revision and commit_pending is None:
+    new_revision = None
+    if commit_pending is None:
+        new_revision = local_tree.last_revision()
         # Automatically commit pending changes if the script did not
         # touch the branch.
-        commit_pending = True
+        commit_pending = last_revision == new_revision
     if commit_pending:
         try:
             new_revision = local_tree.commit(description, allow_pointless=False)
         except PointlessCommit:
             pass
+    if new_revision is None:
+        new_revision = local_tree.last_revision()
     if new_revision == last_revision:
         raise ScriptMadeNoChanges()
     return description
 
 
 def derived_branch_name(script: str) -> str:
-    return os.path.splitext(osutils.basename(script.split(" ")[0]))[0]
+    """Derive a branch name from a script invocation.
 
+    This is the file name of the script, without any extension.
+    """
+    basename = script.split(" ", 1)[0].rpartition("/")[2]
+    stem = basename.rpartition(".")[0]
+    # Like os.path.splitext, leading dots don't start an extension.
+    if not stem.strip("."):
+        return basename
+    return stem
 
-def main(argv: List[str]) -> Optional[int]:  # noqa: C901
-    parser = argparse.ArgumentParser()
-    parser.add_argument("script", help="Path to script to run.", type=str)
-    parser.add_argument("url", help="URL of branch to work on.", type=str)
-    parser.add_argument(
-        "--derived-owner", type=str, default=None, help="Owner for derived branches."
-    )
-    parser.add_argument(
-        "--refresh",
-        action="store_true",
-        help="Refresh changes if branch already exists",
-    )
-    parser.add_argument(
-        "--label", type=str, help="Label to attach", action="append", default=[]
-    )
-    parser.add_argument("--name", type=str, help="Proposed branch name", default=None)
-    parser.add_argument(
-        "--diff", action="store_true", help="Show diff of generated changes."
-    )
-    parser.add_argument(
-        "--mode",
-        help="Mode for pushing",
-        choices=SUPPORTED_MODES,
-        default="propose",
-        type=str,
-    )
-    parser.add_argument(
-        "--commit-pending",
-        help="Commit pending changes after script.",
-        choices=["yes", "no", "auto"],
-        default="auto",
-        type=str,
-    )
-    parser.add_argument(
-        "--dry-run",
-        help="Create branches but don't push or propose anything.",
-        action="store_true",
-        default=False,
+
+def _get_description(
+    description: Optional[str],
+    description_format: str,
+    existing_proposal: Optional[MergeProposal],
+) -> str:
+    if description is not None:
+        return description
+    if existing_proposal is not None:
+        return existing_proposal.get_description()
+    raise ValueError("No description available")
+
+
+def apply_and_publish(  # noqa: C901
+    url: str,
+    name: str,
+    script: str,
+    mode: str,
+    commit_pending: Optional[bool],
+    labels: Optional[List[str]] = None,
+    diff: bool = False,
+    verify_command: Optional[str] = None,
+    derived_owner: Optional[str] = None,
+    refresh: bool = False,
+    dry_run: bool = False,
+    dir: Optional[str] = None,
+    hoster: Optional[Hoster] = None,
+    possible_hosters: Optional[List[Hoster]] = None,
+) -> int:
+    """Run a script against a single branch and publish the result.
+
+    Args:
+      url: URL of the branch to work on
+      name: Name of the derived branch
+      script: Script to run
+      mode: Publish mode (see SUPPORTED_MODES)
+      commit_pending: Whether to commit pending changes after the script
+      labels: Labels to attach to any merge proposal
+      diff: Whether to show a diff of the generated changes
+      verify_command: Command to run to verify the changes
+      derived_owner: Owner for derived branches
+      refresh: Whether to discard any existing changes in a derived branch
+      dry_run: Whether to create branches but not push or propose anything
+      dir: Directory to create the temporary workspace in
+      hoster: Hoster for the branch, if known
+      possible_hosters: Hosters found so far, to reuse for this branch;
+        newly found hosters are added to it
+    Returns:
+      exit code: 0 on success, 1 on failure
+    """
+    # Only needed once there is a branch to work on; this keeps
+    # breezy.merge_directive out of 'svp run --help'.
+    from .proposal import (
+        enable_tag_pushing,
+        find_existing_proposed,
     )
-    parser.add_argument(
-        "--verify-command", type=str, help="Command to run to verify changes."
+    from .workspace import (
+        Workspace,
     )
-    args = parser.parse_args(argv)
 
     try:
-        main_branch = open_branch(args.url)
+        main_branch = open_branch(url)
     except (BranchUnavailable, BranchMissing, BranchUnsupported) as e:
-        logging.exception("%s: %s", args.url, e)
+        logger.error("%s: %s", url, e)
         return 1
 
-    if args.name is None:
-        name = derived_branch_name(args.script)
-    else:
-        name = args.name
-    commit_pending = {"auto": None, "yes": True, "no": False}[args.commit_pending]
-
     overwrite = False
 
     try:
-        hoster = get_hoster(main_branch)
+        if hoster is None:
+            hoster = get_hoster(main_branch, possible_hosters=possible_hosters)
     except UnsupportedHoster as e:
-        if args.mode != "push":
-            raise
+        if mode != "push":
+            logger.error("%s: %s", url, e)
+            return 1
         # We can't figure out what branch to resume from when there's no hoster
         # that can tell us.
         resume_branch = None
         existing_proposal = None
-        logging.warn(
+        logger.warning(
             "Unsupported hoster (%s), will attempt to push to %s",
             e,
             full_branch_url(main_branch),
         )
     else:
         (resume_branch, resume_overwrite, existing_proposal) = find_existing_proposed(
-            main_branch, hoster, name, owner=args.derived_owner
+            main_branch, hoster, name, owner=derived_owner
         )
         if resume_overwrite is not None:
             overwrite = resume_overwrite
-    if args.refresh:
+    if refresh:
         resume_branch = None
-    with Workspace(main_branch, resume_branch=resume_branch) as ws:
+    with Workspace(main_branch, resume_branch=resume_branch, dir=dir) as ws:
         try:
-            description = script_runner(ws.local_tree, args.script, commit_pending)
+            description = script_runner(ws.local_tree, script, commit_pending)
         except ScriptMadeNoChanges:
-            logging.exception("Script did not make any changes.")
+            logger.info("Script did not make any changes.")
             return 1
 
-        if args.verify_command:
+        if verify_command:
             try:
-                subprocess.check_call(
-                    args.verify_command, shell=True, cwd=ws.local_tree.abspath(".")
-                )
-            except subprocess.CalledProcessError:
-                logging.exception("Verify command failed.")
+                check_call_script(verify_command, cwd=ws.local_tree.abspath("."))
+            except subprocess.CalledProcessError as e:
+                logger.error("Verify command failed with exit code %d.", e.returncode)
+                return 1
+            except OSError as e:
+                logger.error("Unable to run verify command: %s", e)
                 return 1
-
-        def get_description(description_format, existing_proposal):
-            if description is not None:
-                return description
-            if existing_proposal is not None:
-                return existing_proposal.get_description()
-            raise ValueError("No description available")
 
         enable_tag_pushing(ws.local_tree.branch)
 
         try:
             publish_result = ws.publish_changes(
-                args.mode,
+                mode,
                 name,
-                get_proposal_description=get_description,
-                dry_run=args.dry_run,
+                get_proposal_description=functools.partial(
+                    _get_description, description
+                ),
+                dry_run=dry_run,
                 hoster=hoster,
-                labels=args.label,
+                labels=labels,
                 overwrite_existing=overwrite,
-                derived_owner=args.derived_owner,
+                derived_owner=derived_owner,
                 existing_proposal=existing_proposal,
             )
         except UnsupportedHoster as e:
-            logging.exception(
+            logger.exception(
                 "No known supported hoster for %s. Run 'svp login'?",
                 full_branch_url(e.branch),
             )
             return 1
         except InsufficientChangesForNewProposal:
-            logging.info('Insufficient changes for a new merge proposal')
+            logger.info("Insufficient changes for a new merge proposal")
             return 0
-        except _mod_propose.HosterLoginRequired as e:
-            logging.exception(
+        except HosterLoginRequired as e:
+            logger.exception(
                 "Credentials for hosting site at %r missing. " "Run 'svp login'?",
                 e.hoster.base_url,
             )
@@ -236,17 +278,149 @@ def main(argv: List[str]) -> Optional[int]:  # noqa: C901
 
         if publish_result.proposal:
             if publish_result.is_new:
-                logging.info("Merge proposal created.")
+                logger.info("Merge proposal created.")
             else:
-                logging.info("Merge proposal updated.")
+                logger.info("Merge proposal updated.")
             if publish_result.proposal.url:
-                logging.info("URL: %s", publish_result.proposal.url)
-            logging.info("Description: %s", publish_result.proposal.get_description())
+                logger.info("URL: %s", publish_result.proposal.url)
+            # Retrieving the description may involve a request to the hoster.
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Description: %s", publish_result.proposal.get_description()
+                )
 
-        if args.diff:
+        if diff:
             ws.show_diff(sys.stdout.buffer)
 
-    return None
+    return 0
+
+
+def _apply_and_publish_in_worker(log_level: int, url: str, kwargs) -> int:
+    """Run apply_and_publish in a worker process.
+
+    Depending on the multiprocessing start method, workers don't inherit
+    the logging configuration of the parent process.
+    """
+    logging.basicConfig(level=log_level, format="%(message)s")
+    return apply_and_publish(url, **kwargs)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script", help="Path to script to run.", type=str)
+    parser.add_argument("url", help="URL of branch to work on.", type=str, nargs="+")
+    parser.add_argument(
+        "--derived-owner", type=str, default=None, help="Owner for derived branches."
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Refresh changes if branch already exists",
+    )
+    parser.add_argument(
+        "--label", type=str, help="Label to attach", action="append", default=[]
+    )
+    parser.add_argument("--name", type=str, help="Proposed branch name", default=None)
+    parser.add_argument(
+        "--diff", action="store_true", help="Show diff of generated changes."
+    )
+    parser.add_argument(
+        "--mode",
+        help="Mode for pushing",
+        choices=SUPPORTED_MODES,
+        default="propose",
+        type=str,
+    )
+    parser.add_argument(
+        "--commit-pending",
+        help="Commit pending changes after script.",
+        choices=["yes", "no", "auto"],
+        default="auto",
+        type=str,
+    )
+    parser.add_argument(
+        "--dry-run",
+        help="Create branches but don't push or propose anything.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--verify-command", type=str, help="Command to run to verify changes."
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of branches to process in parallel.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.name is None:
+        name = derived_branch_name(args.script)
+    else:
+        name = args.name
+    commit_pending = {"auto": None, "yes": True, "no": False}[args.commit_pending]
+
+    kwargs = {
+        "name": name,
+        "script": args.script,
+        "mode": args.mode,
+        "commit_pending": commit_pending,
+        "labels": args.label,
+        "diff": args.diff,
+        "verify_command": args.verify_command,
+        "derived_owner": args.derived_owner,
+        "refresh": args.refresh,
+        "dry_run": args.dry_run,
+        # Reuse the hosters found for earlier branches. With --jobs, each
+        # worker process gets its own copy.
+        "possible_hosters": [],
+    }
+
+    retcode = 0
+    failed = 0
+    # Share a single temporary directory between all the workspaces.
+    with tempfile.TemporaryDirectory(prefix="svp-run-") as td:
+        kwargs["dir"] = td
+        # Each outcome is a callable that returns the exit code for its URL.
+        futures: List[Future] = []
+        executor: Optional[ProcessPoolExecutor] = None
+        if args.jobs > 1 and len(args.url) > 1:
+            # Breezy is not thread-safe, so use separate processes.
+            executor = ProcessPoolExecutor(max_workers=args.jobs)
+            log_level = logging.getLogger().getEffectiveLevel()
+            futures = [
+                executor.submit(_apply_and_publish_in_worker, log_level, url, kwargs)
+                for url in args.url
+            ]
+            outcomes = [future.result for future in futures]
+        else:
+            outcomes = [
+                functools.partial(apply_and_publish, url, **kwargs) for url in args.url
+            ]
+        try:
+            for url, outcome in zip(args.url, outcomes):
+                try:
+                    result = outcome()
+                except Exception:
+                    if len(args.url) == 1:
+                        raise
+                    logger.exception("Error processing %s", url)
+                    result = 1
+                if result:
+                    failed += 1
+                retcode = max(retcode, result)
+        finally:
+            if executor is not None:
+                # Don't start on any more branches if we were interrupted.
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+
+    if len(args.url) > 1:
+        logger.info("Processed %d branches, %d failed.", len(args.url), failed)
+
+    return retcode
 
 
 if __name__ == "__main__":
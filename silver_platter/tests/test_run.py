@@ -16,21 +16,47 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import os
+import tempfile
 
+from breezy import errors
+from breezy.propose import Hoster, UnsupportedHoster, hosters
+from breezy.workingtree import WorkingTree
 from breezy.tests import (
+    TestCase,
     TestCaseWithTransport,
 )
 
 from ..run import (
     ScriptMadeNoChanges,
+    derived_branch_name,
+    main,
     script_runner,
 )
 
 
+class DerivedBranchNameTests(TestCase):
+    def test_script(self):
+        self.assertEqual("fix-typo", derived_branch_name("./fix-typo.py"))
+
+    def test_arguments(self):
+        self.assertEqual("fix", derived_branch_name("/usr/bin/fix.sh --all a.b"))
+
+    def test_no_extension(self):
+        self.assertEqual("fix", derived_branch_name("fix"))
+
+    def test_hidden(self):
+        self.assertEqual(".fix", derived_branch_name(".fix"))
+
+
 class ScriptRunnerTests(TestCaseWithTransport):
     def setUp(self):
         super(ScriptRunnerTests, self).setUp()
         self.tree = self.make_branch_and_tree("tree")
+        # Version bar up front, so that the scripts can change it without
+        # having to run brz to add it.
+        self.build_tree_contents([("tree/bar", "initial\n")])
+        self.tree.add(["bar"])
+        self.tree.commit("initial")
 
         with open("foo.sh", "w") as f:
             f.write(
@@ -38,7 +64,6 @@ class ScriptRunnerTests(TestCaseWithTransport):
 #!/bin/sh
 echo Foo > bar
 echo "Some message"
-brz add --quiet bar
 """
             )
         os.chmod("foo.sh", 0o755)
@@ -64,7 +89,6 @@ brz add --quiet bar
 #!/bin/sh
 echo Foo > bar
 echo "Some message"
-brz add --quiet bar
 brz commit --quiet -m blah
 """
             )
@@ -85,6 +109,23 @@ brz commit --quiet -m blah
             commit_pending=False,
         )
 
+    def test_without_shebang(self):
+        # Like /bin/sh, run executables without a #! line as shell scripts.
+        with open("foo.sh", "w") as f:
+            f.write(
+                """\
+echo Foo > bar
+echo "Some message"
+"""
+            )
+        description = script_runner(self.tree, os.path.abspath("foo.sh"))
+        self.assertEqual(description, "Some message\n")
+
+    def test_builtin(self):
+        description = script_runner(self.tree, ". %s" % os.path.abspath("foo.sh"))
+        self.assertEqual(description, "Some message\n")
+        self.assertRaises(ScriptMadeNoChanges, script_runner, self.tree, "exit 0")
+
     def test_no_changes(self):
         with open("foo.sh", "w") as f:
             f.write(
@@ -100,3 +141,137 @@ echo "Some message"
             os.path.abspath("foo.sh"),
             commit_pending=True,
         )
+
+
+class DummyHoster(Hoster):
+    """Hoster for local branches below a single directory."""
+
+    base = None
+    probes = 0
+
+    @classmethod
+    def probe_from_branch(cls, branch):
+        cls.probes += 1
+        if cls.base is None or not branch.user_url.startswith(cls.base):
+            raise UnsupportedHoster(branch)
+        return cls()
+
+    def hosts(self, branch):
+        return branch.user_url.startswith(self.base)
+
+    def get_derived_branch(self, main_branch, name, project=None, owner=None):
+        raise errors.NotBranchError(name)
+
+    def get_push_url(self, branch):
+        return branch.user_url
+
+
+class MainTests(TestCaseWithTransport):
+    def setUp(self):
+        super(MainTests, self).setUp()
+        # Keep the workspaces inside the test directory.
+        self.overrideAttr(tempfile, "tempdir", self.test_dir)
+        for name in ["a", "b"]:
+            tree = self.make_branch_and_tree(name)
+            self.build_tree_contents([(name + "/bar", "initial\n")])
+            tree.add(["bar"])
+            tree.commit("initial")
+        # Record every run of the script, so the tests can tell which
+        # branches were processed.
+        self.log_path = os.path.abspath("runs.log")
+        with open("foo.sh", "w") as f:
+            f.write(
+                """\
+#!/bin/sh
+pwd >> %s
+echo Foo > bar
+echo "Some message"
+"""
+                % self.log_path
+            )
+        os.chmod("foo.sh", 0o755)
+
+    def run_main(self, urls, dry_run=True, extra_args=None):
+        argv = [os.path.abspath("foo.sh")]
+        argv.extend([os.path.abspath(url) for url in urls])
+        argv.append("--mode=push")
+        if dry_run:
+            argv.append("--dry-run")
+        if extra_args:
+            argv.extend(extra_args)
+        return main(argv)
+
+    def get_runs(self):
+        if not os.path.exists(self.log_path):
+            return 0
+        with open(self.log_path, "r") as f:
+            return len(f.readlines())
+
+    def test_single(self):
+        self.assertEqual(0, self.run_main(["a"]))
+        self.assertEqual(1, self.get_runs())
+
+    def test_push(self):
+        self.assertEqual(0, self.run_main(["a"], dry_run=False))
+        tree = WorkingTree.open("a")
+        self.assertEqual(
+            "Some message\n",
+            tree.branch.repository.get_revision(tree.branch.last_revision()).message,
+        )
+
+    def test_multiple(self):
+        self.assertEqual(0, self.run_main(["a", "b"]))
+        self.assertEqual(2, self.get_runs())
+
+    def test_hoster_reused(self):
+        self.overrideAttr(DummyHoster, "base", self.get_url())
+        self.overrideAttr(DummyHoster, "probes", 0)
+        hosters.register("dummy", DummyHoster)
+        self.addCleanup(hosters.remove, "dummy")
+        self.assertEqual(0, self.run_main(["a", "b"]))
+        self.assertEqual(2, self.get_runs())
+        # The hoster found for the first branch is reused for the second.
+        self.assertEqual(1, DummyHoster.probes)
+
+    def test_failure_does_not_abort(self):
+        # The missing branch is reported, but the others are still processed.
+        self.assertEqual(1, self.run_main(["missing", "a", "b"]))
+        self.assertEqual(2, self.get_runs())
+
+    def test_jobs(self):
+        self.assertEqual(0, self.run_main(["a", "b"], extra_args=["--jobs=2"]))
+        self.assertEqual(2, self.get_runs())
+
+    def test_jobs_failure_does_not_abort(self):
+        self.assertEqual(
+            1, self.run_main(["missing", "a", "b"], extra_args=["--jobs=2"])
+        )
+        self.assertEqual(2, self.get_runs())
+
+    def test_verify_command(self):
+        self.assertEqual(0, self.run_main(["a"], extra_args=["--verify-command=true"]))
+        self.assertEqual(1, self.run_main(["a"], extra_args=["--verify-command=false"]))
+
+    def test_verify_command_shell(self):
+        # Verify commands that need the shell still run through it.
+        self.assertEqual(
+            0, self.run_main(["a"], extra_args=["--verify-command=exit 0"])
+        )
+        with open("check", "w") as f:
+            f.write("test -f bar\n")
+        os.chmod("check", 0o755)
+        self.assertEqual(
+            0,
+            self.run_main(
+                ["a"], extra_args=["--verify-command=%s" % os.path.abspath("check")]
+            ),
+        )
+        self.assertEqual(
+            1, self.run_main(["a"], extra_args=["--verify-command=exit 1"])
+        )
+
+    def test_script_fails(self):
+        with open("foo.sh", "w") as f:
+            f.write("#!/bin/sh\npwd >> %s\nexit 1\n" % self.log_path)
+        self.assertEqual(1, self.run_main(["a", "b"]))
+        self.assertEqual(2, self.get_runs())
@@ -15,16 +15,26 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import os
+
 from breezy.tests import (
+    TestCase,
     TestCaseWithTransport,
 )
 
+from breezy import errors
+
 from ..utils import (
+    BranchMissing,
+    BranchRateLimited,
+    BranchUnavailable,
     TemporarySprout,
+    _convert_exception,
     run_pre_check,
     run_post_check,
     PreCheckFailed,
     PostCheckFailed,
+    split_script,
 )
 
 
@@ -69,6 +79,87 @@ class TemporarySproutTests(TestCaseWithTransport):
             # Commits in the temporary sprout don't affect the original branch.
             self.assertEqual(branch.last_revision(), orig_revid)
 
+    def _test_colocated(self, format):
+        tree = self.make_branch_and_tree(".", format=format)
+        self.build_tree(["a"])
+        tree.add(["a"])
+        tree.commit("Initial")
+        orig_revid = tree.commit("Second")
+        upstream = tree.controldir.create_branch(name="upstream")
+        upstream.generate_revision_history(tree.branch.get_rev_id(1))
+        pristine = tree.controldir.create_branch(name="pristine-tar")
+        pristine.generate_revision_history(orig_revid)
+        with TemporarySprout(
+            tree.branch, ["upstream", "pristine-tar"], dir=self.test_dir
+        ) as sprout:
+            self.assertEqual(orig_revid, sprout.branch.last_revision())
+            self.assertEqual(
+                upstream.last_revision(),
+                sprout.controldir.open_branch(name="upstream").last_revision(),
+            )
+            self.assertEqual(
+                pristine.last_revision(),
+                sprout.controldir.open_branch(name="pristine-tar").last_revision(),
+            )
+
+    def test_colocated_bzr(self):
+        self._test_colocated("2a")
+
+    def test_colocated_git(self):
+        self._test_colocated("git")
+
+
+class SplitScriptTests(TestCase):
+    def test_simple(self):
+        self.assertEqual((["/bin/true"], False), split_script("/bin/true"))
+
+    def test_arguments(self):
+        self.assertEqual(
+            (["./fix.sh", "--foo", "bar"], False), split_script("./fix.sh --foo bar")
+        )
+
+    def test_list(self):
+        self.assertEqual((["a", "b c"], False), split_script(["a", "b c"]))
+
+    def test_metacharacters(self):
+        self.assertEqual(("a | b", True), split_script("a | b"))
+        self.assertEqual(("echo $HOME", True), split_script("echo $HOME"))
+        self.assertEqual(("FOO=1 bar", True), split_script("FOO=1 bar"))
+        self.assertEqual(("'a b'", True), split_script("'a b'"))
+
+    def test_builtins(self):
+        self.assertEqual(("cd /tmp", True), split_script("cd /tmp"))
+        self.assertEqual(("exit 0", True), split_script("exit 0"))
+        self.assertEqual((". ./env.sh", True), split_script(". ./env.sh"))
+        self.assertEqual(("umask 022", True), split_script("umask 022"))
+
+
+class ConvertExceptionTests(TestCase):
+    def test_not_branch(self):
+        e = _convert_exception("http://a/", errors.NotBranchError("http://a/"))
+        self.assertIsInstance(e, BranchMissing)
+
+    def test_subclass(self):
+        # InvalidHttpResponse is a TransportError, but has its own converter.
+        e = _convert_exception(
+            "http://a/",
+            errors.InvalidHttpResponse("http://a/", "Unexpected HTTP status 429"),
+        )
+        self.assertIsInstance(e, BranchRateLimited)
+        self.assertIsInstance(e, BranchUnavailable)
+        e = _convert_exception(
+            "http://a/", errors.InvalidHttpResponse("http://a/", "Bad")
+        )
+        self.assertIsInstance(e, BranchUnavailable)
+
+    def test_status_code(self):
+        e = errors.InvalidHttpResponse("http://a/", "Too many requests")
+        e.code = 429
+        self.assertIsInstance(_convert_exception("http://a/", e), BranchRateLimited)
+
+    def test_unknown(self):
+        self.assertIs(None, _convert_exception("http://a/", KeyError("x")))
+
 
 class RunPreCheckTests(TestCaseWithTransport):
     def test_none(self):
@@ -83,6 +174,23 @@ class RunPreCheckTests(TestCaseWithTransport):
         tree = self.make_branch_and_tree("tree")
         self.assertIs(run_pre_check(tree, "/bin/true"), None)
 
+    def test_missing(self):
+        tree = self.make_branch_and_tree("tree")
+        self.assertRaises(
+            PreCheckFailed, run_pre_check, tree, "/nonexistent/script --arg"
+        )
+
+    def test_builtin(self):
+        tree = self.make_branch_and_tree("tree")
+        self.assertIs(run_pre_check(tree, "exit 0"), None)
+        self.assertRaises(PreCheckFailed, run_pre_check, tree, "exit 1")
+
+    def test_without_shebang(self):
+        tree = self.make_branch_and_tree("tree")
+        self.build_tree_contents([("tree/check", "test -d .bzr\n")])
+        os.chmod("tree/check", 0o755)
+        self.assertIs(run_pre_check(tree, "./check"), None)
+
 
 class RunPostCheckTests(TestCaseWithTransport):
     def test_none(self):
@@ -100,3 +208,33 @@ class RunPostCheckTests(TestCaseWithTransport):
         tree = self.make_branch_and_tree("tree")
         cid = tree.commit("a")
         self.assertIs(run_post_check(tree, "/bin/true", since_revid=cid), None)
+
+    def test_environment(self):
+        tree = self.make_branch_and_tree("tree")
+        cid = tree.commit("a")
+        # The script sees SINCE_REVID, and the rest of the environment.
+        self.assertIs(
+            run_post_check(
+                tree,
+                'test "$SINCE_REVID" = "%s" -a -n "$HOME"' % cid.decode(),
+                since_revid=cid,
+            ),
+            None,
+        )
+
+    def test_builtin(self):
+        tree = self.make_branch_and_tree("tree")
+        cid = tree.commit("a")
+        self.assertIs(run_post_check(tree, "exit 0", since_revid=cid), None)
+        self.assertRaises(
+            PostCheckFailed, run_post_check, tree, "exit 1", since_revid=cid
+        )
+
+    def test_without_shebang(self):
+        tree = self.make_branch_and_tree("tree")
+        cid = tree.commit("a")
+        self.build_tree_contents(
+            [("tree/check", 'test "$SINCE_REVID" = "%s"\n' % cid.decode())]
+        )
+        os.chmod("tree/check", 0o755)
+        self.assertIs(run_post_check(tree, "./check", since_revid=cid), None)
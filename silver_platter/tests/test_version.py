@@ -22,17 +22,16 @@ from unittest import TestCase
 from silver_platter import version_string
 
 
+_SETUP_VERSION_RE = re.compile(r'^[ ]*version=["\'](.*)["\'],', re.MULTILINE)
+
+
 class VersionMatchTest(TestCase):
     def test_matches_setup_version(self):
-        if not os.path.exists("setup.py"):
-            self.skipTest("no setup.py available. " "Running outside of source tree?")
-        # TODO(jelmer): Surely there's a better way of doing this?
-        with open("setup.py", "r") as f:
-            for line in f:
-                m = re.match(r'[ ]*version=["\'](.*)["\'],', line)
-                if m:
-                    setup_version = m.group(1)
-                    break
-            else:
-                raise AssertionError("setup version not found")
-        self.assertEqual(version_string, setup_version)
+        setup_py = os.path.join(os.path.dirname(__file__), "..", "..", "setup.py")
+        if not os.path.exists(setup_py):
+            self.skipTest("no setup.py available. Running outside of source tree?")
+        with open(setup_py, "r") as f:
+            m = _SETUP_VERSION_RE.search(f.read())
+        if not m:
+            raise AssertionError("setup version not found")
+        self.assertEqual(version_string, m.group(1))
@@ -15,11 +15,14 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import errno
+import functools
 import os
+import shlex
 import shutil
 import socket
 import subprocess
-from typing import Callable, Tuple, Optional, List
+from typing import Callable, Dict, Tuple, Optional, List, Union
 
 from breezy import (
     config as _mod_config,
@@ -37,8 +40,10 @@ from breezy.branch import (
     Branch,
     BranchWriteLockResult,
 )
+from breezy.bzr.vf_search import PendingAncestryResult
 from breezy.controldir import ControlDir, Prober
 from breezy.git.remote import RemoteGitError
+from breezy.repository import InterRepository
 from breezy.revision import NULL_REVISION
 from breezy.transport import Transport, get_transport
 from breezy.workingtree import WorkingTree
@@ -80,15 +85,27 @@ def create_temp_sprout(
             stacked=use_stacking,
         )
         # TODO(jelmer): Fetch these during the initial clone
+        colocated_branches = []
         for branch_name in set(additional_colocated_branches or []):
             try:
                 add_branch = branch.controldir.open_branch(name=branch_name)
             except (errors.NotBranchError, errors.NoColocatedBranchSupport):
                 pass
             else:
-                local_add_branch = to_dir.create_branch(name=branch_name)
-                add_branch.push(local_add_branch)
-                assert add_branch.last_revision() == local_add_branch.last_revision()
+                colocated_branches.append((branch_name, add_branch))
+        heads = [add_branch.last_revision() for (_, add_branch) in colocated_branches]
+        heads = [revid for revid in heads if revid != NULL_REVISION]
+        if heads:
+            # Fetch the history of all colocated branches in one go, rather
+            # than once per branch in the pushes below. Repository.fetch only
+            # takes a fetch_spec on some repository formats, so go through
+            # InterRepository.
+            inter = InterRepository.get(branch.repository, to_dir.find_repository())
+            inter.fetch(fetch_spec=PendingAncestryResult(heads, branch.repository))
+        for branch_name, add_branch in colocated_branches:
+            local_add_branch = to_dir.create_branch(name=branch_name)
+            add_branch.push(local_add_branch)
+            assert add_branch.last_revision() == local_add_branch.last_revision()
         return to_dir.open_workingtree(), destroy
     except BaseException as e:
         destroy()
@@ -124,6 +141,84 @@ class TemporarySprout(object):
         return False
 
 
+# Characters that mean a script needs to be interpreted by the shell.
+_SHELL_METACHARACTERS = frozenset("|&;<>()$`\\\"'*?[#~=%\n")
+
+# Commands that only exist inside the shell: reserved words, and builtins that
+# either have no executable equivalent or only affect the shell itself.
+_SHELL_BUILTINS = frozenset(
+    (
+        "! { } case do done elif else esac fi for if in then until while "
+        ". : alias bg break cd command continue eval exec exit export fg getopts "
+        "hash jobs local read readonly return set shift source times trap type "
+        "ulimit umask unalias unset wait"
+    ).split()
+)
+
+
+def split_script(script: Union[str, List[str]]) -> Tuple[Union[str, List[str]], bool]:
+    """Determine how to invoke a script.
+
+    Simple commands are run directly rather than through /bin/sh, saving
+    a fork and exec.
+
+    Args:
+      script: Command to run, either as a shell string or an argument list
+    Returns:
+      Tuple with the arguments to pass to subprocess and whether they need
+      to be run with shell=True
+    """
+    if not isinstance(script, str):
+        return list(script), False
+    if _SHELL_METACHARACTERS.intersection(script):
+        return script, True
+    args = shlex.split(script)
+    if not args or args[0] in _SHELL_BUILTINS:
+        return script, True
+    return args, False
+
+
+def popen_script(script: Union[str, List[str]], **kwargs) -> subprocess.Popen:
+    """Start a script.
+
+    Simple commands are executed directly, see split_script. Like the
+    shell, executable files without a #! line are run as shell scripts.
+
+    Args:
+      script: Command to run, either as a shell string or an argument list
+      kwargs: Additional arguments for subprocess.Popen
+    Returns:
+      The started process
+    Raises:
+      OSError: If the script could not be started
+    """
+    args, shell = split_script(script)
+    if shell:
+        return subprocess.Popen(args, shell=True, **kwargs)
+    try:
+        return subprocess.Popen(args, **kwargs)
+    except OSError as e:
+        if e.errno != errno.ENOEXEC:
+            raise
+        return subprocess.Popen(["/bin/sh", *args], **kwargs)
+
+
+def check_call_script(script: Union[str, List[str]], **kwargs) -> None:
+    """Run a script and wait for it to finish.
+
+    Args:
+      script: Command to run, either as a shell string or an argument list
+      kwargs: Additional arguments for subprocess.Popen
+    Raises:
+      OSError: If the script could not be started
+      subprocess.CalledProcessError: If the script exited with an error
+    """
+    with popen_script(script, **kwargs) as p:
+        retcode = p.wait()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, script)
+
+
 class PreCheckFailed(Exception):
     """The post check failed."""
 
@@ -140,8 +235,8 @@ def run_pre_check(tree: WorkingTree, script: Optional[str]) -> None:
     if not script:
         return
     try:
-        subprocess.check_call(script, shell=True, cwd=tree.basedir)
-    except subprocess.CalledProcessError:
+        check_call_script(script, cwd=tree.basedir)
+    except (subprocess.CalledProcessError, OSError):
         raise PreCheckFailed()
 
 
@@ -164,10 +259,10 @@ def run_post_check(
     if not script:
         return
     try:
-        subprocess.check_call(
-            script, shell=True, cwd=tree.basedir, env={"SINCE_REVID": since_revid}
+        check_call_script(
+            script, cwd=tree.basedir, env=dict(os.environ, SINCE_REVID=since_revid)
         )
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         raise PostCheckFailed()
 
 
@@ -182,16 +277,9 @@ class BranchUnavailable(Exception):
         return self.description
 
 
-class BranchRateLimited(Exception):
+class BranchRateLimited(BranchUnavailable):
     """Opening branch was rate-limited."""
 
-    def __init__(self, url: str, description: str):
-        self.url = url
-        self.description = description
-
-    def __str__(self) -> str:
-        return self.description
-
 
 class BranchMissing(Exception):
     """Branch did not exist."""
@@ -215,34 +303,97 @@ class BranchUnsupported(Exception):
         return self.description
 
 
+def _convert_socket_error(url: str, e: Exception) -> Exception:
+    return BranchUnavailable(url, "Socket error: %s" % e)
+
+
+def _convert_not_branch_error(url: str, e: Exception) -> Exception:
+    return BranchMissing(url, "Branch does not exist: %s" % e)
+
+
+def _convert_unsupported(url: str, e: Exception) -> Exception:
+    return BranchUnsupported(url, str(e))
+
+
+def _convert_unavailable(url: str, e: Exception) -> Exception:
+    return BranchUnavailable(url, str(e))
+
+
+def _convert_invalid_http_response(url: str, e: Exception) -> Exception:
+    # Newer versions of breezy raise UnexpectedHttpStatus, which carries the
+    # status code; older ones only mention it in the message.
+    msg = str(e)
+    code = getattr(e, "code", None)
+    if code is None:
+        rate_limited = "Unexpected HTTP status 429" in msg
+    else:
+        rate_limited = code == 429
+    if rate_limited:
+        return BranchRateLimited(url, msg)
+    return BranchUnavailable(url, msg)
+
+
+# Converters for exceptions raised while opening a branch, by exception
+# class. Looked up along the MRO, so the most specific class wins.
+_EXCEPTION_CONVERTERS: Dict[type, Callable[[str, Exception], Exception]] = {
+    socket.error: _convert_socket_error,
+    errors.NotBranchError: _convert_not_branch_error,
+    errors.UnsupportedProtocol: _convert_unsupported,
+    errors.ConnectionError: _convert_unavailable,
+    errors.PermissionDenied: _convert_unavailable,
+    errors.InvalidHttpResponse: _convert_invalid_http_response,
+    errors.TransportError: _convert_unavailable,
+    UnusableRedirect: _convert_unavailable,
+    errors.UnsupportedFormatError: _convert_unsupported,
+    errors.UnknownFormatError: _convert_unsupported,
+    RemoteGitError: _convert_unavailable,
+    LineEndingError: _convert_unavailable,
+}
+
+
+_exception_converter_cache: Dict[
+    type, Optional[Callable[[str, Exception], Exception]]
+] = {}
+
+
+def _find_exception_converter(
+    exc_cls: type,
+) -> Optional[Callable[[str, Exception], Exception]]:
+    try:
+        return _exception_converter_cache[exc_cls]
+    except KeyError:
+        pass
+    converter = None
+    for cls in exc_cls.__mro__:
+        converter = _EXCEPTION_CONVERTERS.get(cls)
+        if converter is not None:
+            break
+    _exception_converter_cache[exc_cls] = converter
+    return converter
+
+
 def _convert_exception(url: str, e: Exception) -> Optional[Exception]:
-    if isinstance(e, socket.error):
-        return BranchUnavailable(url, "Socket error: %s" % e)
-    if isinstance(e, errors.NotBranchError):
-        return BranchMissing(url, "Branch does not exist: %s" % e)
-    if isinstance(e, errors.UnsupportedProtocol):
-        return BranchUnsupported(url, str(e))
-    if isinstance(e, errors.ConnectionError):
-        return BranchUnavailable(url, str(e))
-    if isinstance(e, errors.PermissionDenied):
-        return BranchUnavailable(url, str(e))
-    if isinstance(e, errors.InvalidHttpResponse):
-        if "Unexpected HTTP status 429" in str(e):
-            raise BranchRateLimited(url, str(e))
-        return BranchUnavailable(url, str(e))
-    if isinstance(e, errors.TransportError):
-        return BranchUnavailable(url, str(e))
-    if UnusableRedirect is not None and isinstance(e, UnusableRedirect):
-        return BranchUnavailable(url, str(e))
-    if isinstance(e, errors.UnsupportedFormatError):
-        return BranchUnsupported(url, str(e))
-    if isinstance(e, errors.UnknownFormatError):
-        return BranchUnsupported(url, str(e))
-    if isinstance(e, RemoteGitError):
-        return BranchUnavailable(url, str(e))
-    if isinstance(e, LineEndingError):
-        return BranchUnavailable(url, str(e))
-    return None
+    converter = _find_exception_converter(type(e))
+    if converter is None:
+        return None
+    return converter(url, e)
+
+
+@functools.lru_cache(maxsize=256)
+def _split_segment_parameters_cached(
+    url: str,
+) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    url, params = urlutils.split_segment_parameters(url)
+    return url, tuple(params.items())
+
+
+def _split_segment_parameters(url: str) -> Tuple[str, Dict[str, str]]:
+    """Split the segment parameters off a URL, caching the result.
+
+    Returns a new parameters dict on every call, so callers may modify it.
+    """
+    url, params = _split_segment_parameters_cached(url)
+    return url, dict(params)
 
 
 def open_branch(
@@ -252,7 +403,7 @@ def open_branch(
     name: str = None,
 ) -> Branch:
     """Open a branch by URL."""
-    url, params = urlutils.split_segment_parameters(url)
+    url, params = _split_segment_parameters(url)
     if name is None:
         try:
             name = urlutils.unquote(params["branch"])
@@ -306,7 +457,6 @@ except ImportError:  # breezy < 3.1.1
             self._last_revision_info_cache = None
             self._revision_id_to_revno_cache = None
             self._partial_revision_id_to_revno_cache = {}
-            self._partial_revision_history_cache = []
             self.base = "memory://" + osutils.rand_chars(10)
 
         def get_config(self):
@@ -363,7 +513,7 @@ def full_branch_url(branch):
     """
     if branch.name is None:
         return branch.user_url
-    url, params = urlutils.split_segment_parameters(branch.user_url)
+    url, params = _split_segment_parameters(branch.user_url)
     if branch.name != "":
         params["branch"] = urlutils.quote(branch.name, "")
     return urlutils.join_segment_parameters(url, params)